@@ -888,8 +888,8 @@ class CenterNetCenterHeatmapTargetAssigner(object):
 
     out_height = tf.cast(height // self._stride, tf.float32)
     out_width = tf.cast(width // self._stride, tf.float32)
-    # Compute the yx-grid to be used to generate the heatmap. Each returned
-    # tensor has shape of [out_height, out_width]
+    # Compute the yx-grid to be used to generate the heatmap. The returned
+    # tensors have shapes [out_height, 1] and [1, out_width].
     (y_grid, x_grid) = ta_utils.image_shape_to_grids(out_height, out_width)
 
     heatmaps = []
@@ -1228,8 +1228,8 @@ class CenterNetKeypointTargetAssigner(object):
     """
     out_width = tf.cast(width // self._stride, tf.float32)
     out_height = tf.cast(height // self._stride, tf.float32)
-    # Compute the yx-grid to be used to generate the heatmap. Each returned
-    # tensor has shape of [out_height, out_width]
+    # Compute the yx-grid to be used to generate the heatmap. The returned
+    # tensors have shapes [out_height, 1] and [1, out_width].
     y_grid, x_grid = ta_utils.image_shape_to_grids(out_height, out_width)
 
     if gt_keypoints_weights_list is None:
@@ -1308,9 +1308,10 @@ class CenterNetKeypointTargetAssigner(object):
           y_coordinates=tf.keras.backend.flatten(keypoints_absolute[:, :, 0]),
           x_coordinates=tf.keras.backend.flatten(keypoints_absolute[:, :, 1]),
           sigma=tf.keras.backend.flatten(keypoint_std_dev),
-          channel_onehot=tf.one_hot(
-              tf.keras.backend.flatten(keypoint_types), depth=num_keypoints),
-          channel_weights=tf.keras.backend.flatten(kp_weights))
+          channel_onehot=None,
+          channel_weights=tf.keras.backend.flatten(kp_weights),
+          class_ids=tf.keras.backend.flatten(keypoint_types),
+          num_channels=num_keypoints)
       num_instances_list.append(
           tf.cast(tf.reduce_sum(kp_weights, axis=0), dtype=tf.int32))
       heatmaps.append(heatmap)
@@ -14,9 +14,21 @@
 # ==============================================================================
 """Utility functions used by target assigner."""
 
+import functools
+
+import numpy as np
 import tensorflow.compat.v1 as tf
 
 from object_detection.utils import shape_utils
+from object_detection.utils import tf_version
+
+# pylint: disable=g-import-not-at-top
+try:
+  import numba
+except ImportError:
+  # numba is optional and only used to speed up eager heatmaps on CPU.
+  numba = None
+# pylint: enable=g-import-not-at-top
 
 
 def image_shape_to_grids(height, width):
@@ -28,91 +40,407 @@ def image_shape_to_grids(height, width):
 
   Returns:
     A tuple of two tensors:
-      y_grid: A float tensor with shape [height, width] representing the
-        y-coordinate of each pixel grid.
-      x_grid: A float tensor with shape [height, width] representing the
-        x-coordinate of each pixel grid.
+      y_grid: A float tensor with shape [height, 1] representing the
+        y-coordinate of each pixel row.
+      x_grid: A float tensor with shape [1, width] representing the
+        x-coordinate of each pixel column.
+    The two grids broadcast against each other to [height, width], so the full
+    meshgrid is never materialized.
   """
+  static_height = tf.get_static_value(height)
+  static_width = tf.get_static_value(width)
+  # Eager grids of a known shape are reused across calls. Graph tensors can
+  # not be shared between graphs, so they are always rebuilt.
+  if (tf.executing_eagerly() and static_height is not None and
+      static_width is not None):
+    return _cached_image_shape_to_grids(float(static_height),
+                                        float(static_width))
+  return _image_shape_to_grids(height, width)
+
+
+def _image_shape_to_grids(height, width):
+  """Builds the broadcastable xy-grids of image_shape_to_grids."""
   out_height = tf.cast(height, tf.float32)
   out_width = tf.cast(width, tf.float32)
   x_range = tf.range(out_width, dtype=tf.float32)
   y_range = tf.range(out_height, dtype=tf.float32)
-  x_grid, y_grid = tf.meshgrid(x_range, y_range, indexing='xy')
-  return (y_grid, x_grid)
+  return (y_range[:, tf.newaxis], x_range[tf.newaxis, :])
 
 
-def _coordinates_to_heatmap_dense(y_grid, x_grid, y_coordinates, x_coordinates,
-                                  sigma, channel_onehot, channel_weights=None):
-  """Dense version of coordinates to heatmap that uses an outer product."""
-  num_instances, num_channels = (
-      shape_utils.combined_static_and_dynamic_shape(channel_onehot))
+@functools.lru_cache(maxsize=16)
+def _cached_image_shape_to_grids(height, width):
+  """Returns the eager xy-grids for a static image shape."""
+  return _image_shape_to_grids(height, width)
+
+
+def _can_use_traced_function(tensors, dtype=tf.float32):
+  """Whether to call the pre-traced graph version of a function.
+
+  In eager mode every op is dispatched separately, so running the whole
+  function as a single graph traced once (with relaxed shapes given by its
+  input_signature) avoids that overhead. Inside a graph the ops are staged
+  anyway and the plain function is used.
+
+  Args:
+    tensors: A list of the tensor arguments of the function.
+    dtype: The dtype all the tensors are expected to have.
+
+  Returns:
+    A boolean indicating whether the traced function can be used.
+  """
+  return tf.executing_eagerly() and all(
+      tf.is_tensor(t) and t.dtype == dtype for t in tensors)
+
 
-  x_grid = tf.expand_dims(x_grid, 2)
-  y_grid = tf.expand_dims(y_grid, 2)
+# Gaussian values below exp(-4.6052) ~= 0.01 of the peak are truncated to zero
+# when the heatmap is only evaluated in a local window around each point.
+_GAUSSIAN_TRUNCATION_THRESHOLD = 4.6052
+
+
+def _separable_gaussian_profiles(y_grid, x_grid, y_coordinates, x_coordinates,
+                                 sigma):
+  """Computes the 1D Gaussian profiles of each instance.
+
+  The 2D Gaussian kernel is separable, i.e. G(y, x) = Gy(y) * Gx(x), so the
+  exponential is only evaluated on the [height, N] and [width, N] 1D profiles
+  and the full maps are formed with a single outer product.
+
+  Args:
+    y_grid: A 2D tensor with shape [height, 1] (or [height, width]).
+    x_grid: A 2D tensor with shape [1, width] (or [height, width]).
+    y_coordinates: A 1D tensor with shape [num_instances].
+    x_coordinates: A 1D tensor with shape [num_instances].
+    sigma: A 1D tensor with shape [num_instances].
+
+  Returns:
+    A tuple of two tensors with shapes [height, num_instances] and
+    [width, num_instances].
+  """
   # The raw center coordinates in the output space.
-  x_diff = x_grid - tf.math.floor(x_coordinates)
-  y_diff = y_grid - tf.math.floor(y_coordinates)
-  squared_distance = x_diff**2 + y_diff**2
+  y_range = y_grid[:, 0]
+  x_range = x_grid[0, :]
+  y_diff = y_range[:, tf.newaxis] - tf.math.floor(y_coordinates)[tf.newaxis, :]
+  x_diff = x_range[:, tf.newaxis] - tf.math.floor(x_coordinates)[tf.newaxis, :]
+  # The [num_instances] reciprocal is computed once so the exponent over the
+  # profiles is a multiply instead of a division.
+  inv_two_sigma_squared = 1.0 / (2 * sigma * sigma)
 
-  gaussian_map = tf.exp(-squared_distance / (2 * sigma * sigma))
+  y_gaussian = tf.exp(-y_diff**2 * inv_two_sigma_squared)
+  x_gaussian = tf.exp(-x_diff**2 * inv_two_sigma_squared)
+  return y_gaussian, x_gaussian
 
-  reshaped_gaussian_map = tf.expand_dims(gaussian_map, axis=-1)
-  reshaped_channel_onehot = tf.reshape(channel_onehot,
-                                       (1, 1, num_instances, num_channels))
-  gaussian_per_box_per_class_map = (
-      reshaped_gaussian_map * reshaped_channel_onehot)
 
-  if channel_weights is not None:
-    reshaped_weights = tf.reshape(channel_weights, (1, 1, num_instances, 1))
-    gaussian_per_box_per_class_map *= reshaped_weights
+def _get_num_channels(channel_onehot):
+  """Returns the static number of channels if known, else a scalar tensor."""
+  num_channels = tf.compat.dimension_value(channel_onehot.shape[-1])
+  if num_channels is None:
+    num_channels = tf.shape(channel_onehot)[-1]
+  return num_channels
+
+
+def _segment_max_heatmap(y_gaussian, x_gaussian, class_ids, instance_scale,
+                         num_channels):
+  """Merges the per-instance Gaussians into per-class heatmaps by class id.
+
+  Each instance belongs to a single channel, so the per-class maximum can be
+  taken with a segment reduction over the [num_instances, height, width] map
+  instead of expanding it by num_channels.
+
+  Args:
+    y_gaussian: A float tensor with shape [height, num_instances].
+    x_gaussian: A float tensor with shape [width, num_instances].
+    class_ids: An int32 tensor with shape [num_instances].
+    instance_scale: A float tensor with shape [num_instances] scaling the
+      Gaussian of each instance.
+    num_channels: The number of output channels.
 
-  # Take maximum along the "instance" dimension so that all per-instance
-  # heatmaps of the same class are merged together.
-  heatmap = tf.reduce_max(gaussian_per_box_per_class_map, axis=2)
+  Returns:
+    A float tensor with shape [height, width, num_channels]. Channels without
+    any instance hold the lowest float value.
+  """
+  # The per-instance scale is folded into the [width, num_instances] profile
+  # and the outer product directly yields the [num_instances, height, width]
+  # layout the segment reduction needs.
+  gaussian_per_box_map = tf.einsum('hn,wn->nhw', y_gaussian,
+                                   x_gaussian * instance_scale)
+  heatmap = tf.math.unsorted_segment_max(
+      gaussian_per_box_map, class_ids, num_channels)
+  return tf.transpose(heatmap, (1, 2, 0))
+
+
+def _dense_heatmap_from_class_ids(y_grid, x_grid, y_coordinates, x_coordinates,
+                                  sigma, class_ids, channel_weights,
+                                  num_channels):
+  """Computes the per-class heatmap of points given by their class ids."""
+  y_gaussian, x_gaussian = _separable_gaussian_profiles(
+      y_grid, x_grid, y_coordinates, x_coordinates, sigma)
+  heatmap = _segment_max_heatmap(y_gaussian, x_gaussian, class_ids,
+                                 channel_weights, num_channels)
+  # Maximum of an empty tensor is -inf, the following is to avoid that.
+  return tf.maximum(heatmap, 0)
+
+
+def _dense_heatmap_from_gaussian(y_grid, x_grid, y_coordinates, x_coordinates,
+                                 sigma, channel_onehot, channel_weights):
+  """Computes the per-class heatmap; XLA can fuse the body into one kernel."""
+  num_channels = _get_num_channels(channel_onehot)
+
+  y_gaussian, x_gaussian = _separable_gaussian_profiles(
+      y_grid, x_grid, y_coordinates, x_coordinates, sigma)
+
+  def one_hot_heatmap():
+    class_ids = tf.argmax(channel_onehot, axis=1, output_type=tf.int32)
+    instance_scale = tf.reduce_sum(channel_onehot, axis=1) * channel_weights
+    return _segment_max_heatmap(y_gaussian, x_gaussian, class_ids,
+                                instance_scale, num_channels)
+
+  def k_hot_heatmap():
+    gaussian_map = tf.einsum('hn,wn->hwn', y_gaussian,
+                             x_gaussian * channel_weights)
+    gaussian_per_box_per_class_map = (
+        gaussian_map[:, :, :, tf.newaxis] *
+        channel_onehot[tf.newaxis, tf.newaxis, :, :])
+
+    # Take maximum along the "instance" dimension so that all per-instance
+    # heatmaps of the same class are merged together.
+    return tf.reduce_max(gaussian_per_box_per_class_map, axis=2)
+
+  is_one_hot = tf.reduce_all(
+      tf.math.count_nonzero(channel_onehot, axis=1) <= 1)
+  heatmap = tf.cond(is_one_hot, one_hot_heatmap, k_hot_heatmap)
 
   # Maximum of an empty tensor is -inf, the following is to avoid that.
-  heatmap = tf.maximum(heatmap, 0)
+  return tf.maximum(heatmap, 0)
+
+
+def _xla_function(fn):
+  """Returns fn compiled with XLA, or None if this TF version can't do it."""
+  if not tf_version.is_tf2():
+    return None
+  # `experimental_compile` was renamed to `jit_compile` in TF 2.5.
+  for compile_kwarg in ('jit_compile', 'experimental_compile'):
+    try:
+      return tf.function(fn, **{compile_kwarg: True})
+    except TypeError:
+      pass
+  return None
+
+
+# With XLA, the exp, the per-instance scaling and the reduction over instances
+# are fused into a single kernel.
+_dense_heatmap_from_gaussian_fused = _xla_function(_dense_heatmap_from_gaussian)
+_dense_heatmap_from_class_ids_fused = _xla_function(
+    _dense_heatmap_from_class_ids)
 
+
+def _can_use_xla(fused_fn, *tensors):
+  """Whether the XLA compiled version of a heatmap function should be used.
+
+  XLA compiles a new kernel for every distinct input shape, e.g. for every
+  number of instances when the groundtruth is unpadded, and a compilation
+  costs far more than it saves. The compiled version is therefore only used
+  in graph mode when all input shapes are static.
+  """
+  if fused_fn is None or tf.executing_eagerly():
+    return False
+  return all(tf.is_tensor(t) and t.shape.is_fully_defined() for t in tensors)
+
+
+def _coordinates_to_heatmap_dense(y_grid, x_grid, y_coordinates, x_coordinates,
+                                  sigma, channel_onehot, channel_weights=None):
+  """Dense version of coordinates to heatmap that uses an outer product."""
+  if channel_weights is None:
+    channel_weights = tf.ones_like(y_coordinates)
+  inputs = [y_grid, x_grid, y_coordinates, x_coordinates, sigma,
+            channel_onehot, channel_weights]
+  if _can_use_xla(_dense_heatmap_from_gaussian_fused, *inputs):
+    heatmap = _dense_heatmap_from_gaussian_fused(*inputs)
+  else:
+    heatmap = _dense_heatmap_from_gaussian(*inputs)
   return tf.stop_gradient(heatmap)
 
 
+def _coordinates_to_heatmap_dense_from_class_ids(y_grid, x_grid, y_coordinates,
+                                                 x_coordinates, sigma,
+                                                 class_ids, channel_weights,
+                                                 num_channels):
+  """Dense version of coordinates to heatmap for integer class ids."""
+  inputs = [y_grid, x_grid, y_coordinates, x_coordinates, sigma, class_ids,
+            channel_weights]
+  # XLA needs the number of segments to be a compile time constant.
+  if (isinstance(num_channels, int) and
+      _can_use_xla(_dense_heatmap_from_class_ids_fused, *inputs)):
+    heatmap_fn = _dense_heatmap_from_class_ids_fused
+  else:
+    heatmap_fn = _dense_heatmap_from_class_ids
+  heatmap = heatmap_fn(*inputs, num_channels)
+  return tf.stop_gradient(heatmap)
+
+
+if numba is not None:
+
+  @numba.njit(parallel=True, fastmath=True)
+  def _coordinates_to_heatmap_numba(y_range, x_range, y_coordinates,
+                                    x_coordinates, sigma, channel_onehot,
+                                    channel_weights):
+    """Computes the same heatmap as the dense version with native loops."""
+    num_instances, num_channels = channel_onehot.shape
+    height = y_range.shape[0]
+    width = x_range.shape[0]
+    heatmap = np.zeros((height, width, num_channels), dtype=np.float32)
+    # Each channel is written by a single thread.
+    for c in numba.prange(num_channels):
+      x_gaussian = np.empty(width, dtype=np.float32)
+      for i in range(num_instances):
+        scale = channel_onehot[i, c] * channel_weights[i]
+        # Non-positive values are clipped to 0 in the output anyway.
+        if scale <= 0:
+          continue
+        y_center = np.floor(y_coordinates[i])
+        x_center = np.floor(x_coordinates[i])
+        inv_two_sigma_squared = 1.0 / (2 * sigma[i] * sigma[i])
+        for x in range(width):
+          x_gaussian[x] = np.exp(-(x_range[x] - x_center)**2 *
+                                 inv_two_sigma_squared)
+        for y in range(height):
+          y_value = scale * np.exp(-(y_range[y] - y_center)**2 *
+                                   inv_two_sigma_squared)
+          for x in range(width):
+            value = y_value * x_gaussian[x]
+            if value > heatmap[y, x, c]:
+              heatmap[y, x, c] = value
+    return heatmap
+
+
+def _can_use_numba(*tensors):
+  """Whether the eager CPU fast path of coordinates_to_heatmap applies.
+
+  The kernel computes in float32, so it is only used when all given tensors
+  are float32 CPU tensors to keep the output dtype of the TF version.
+  """
+  if numba is None or not tf.executing_eagerly():
+    return False
+  return all(
+      tf.is_tensor(t) and t.dtype == tf.float32 and 'CPU' in t.device
+      for t in tensors if t is not None)
+
+
+def _coordinates_to_heatmap_eager_cpu(y_grid, x_grid, y_coordinates,
+                                      x_coordinates, sigma, channel_onehot,
+                                      channel_weights=None):
+  """Eager CPU version of the dense heatmap that runs in a numba kernel."""
+
+  def to_numpy(tensor):
+    return np.ascontiguousarray(np.asarray(tensor, dtype=np.float32))
+
+  if channel_weights is None:
+    channel_weights = tf.ones_like(y_coordinates)
+  heatmap = _coordinates_to_heatmap_numba(
+      to_numpy(y_grid)[:, 0], to_numpy(x_grid)[0, :],
+      to_numpy(y_coordinates), to_numpy(x_coordinates), to_numpy(sigma),
+      to_numpy(channel_onehot), to_numpy(channel_weights))
+  return tf.constant(heatmap)
+
+
 def _coordinates_to_heatmap_sparse(y_grid, x_grid, y_coordinates, x_coordinates,
                                    sigma, channel_onehot, channel_weights=None):
-  """Sparse version of coordinates to heatmap using tf.scatter."""
+  """Sparse version of coordinates to heatmap using tf.scatter.
+
+  The Gaussian is only evaluated at the pixels within a ~3 sigma radius of
+  each point and max-scattered into the output, so the cost scales with the
+  area of the Gaussians rather than with the full image area. The number of
+  evaluated pixels is data dependent, so this version is not suited for XLA
+  compilation.
+  """
+
+  if channel_weights is None:
+    channel_weights = tf.ones_like(y_coordinates)
+  return _coordinates_to_heatmap_sparse_from_class_ids(
+      y_grid, x_grid, y_coordinates, x_coordinates, sigma,
+      tf.argmax(channel_onehot, axis=1, output_type=tf.int32), channel_weights,
+      _get_num_channels(channel_onehot))
 
+
+def _coordinates_to_heatmap_sparse_from_class_ids(y_grid, x_grid,
+                                                  y_coordinates, x_coordinates,
+                                                  sigma, class_ids,
+                                                  channel_weights,
+                                                  num_channels):
+  """Sparse version of coordinates to heatmap for integer class ids."""
   if not hasattr(tf, 'tensor_scatter_nd_max'):
     raise RuntimeError(
         ('Please upgrade tensowflow to use `tensor_scatter_nd_max` or set '
          'compute_heatmap_sparse=False'))
-  _, num_channels = (
-      shape_utils.combined_static_and_dynamic_shape(channel_onehot))
-
-  height, width = shape_utils.combined_static_and_dynamic_shape(y_grid)
-  x_grid = tf.expand_dims(x_grid, 2)
-  y_grid = tf.expand_dims(y_grid, 2)
-  # The raw center coordinates in the output space.
-  x_diff = x_grid - tf.math.floor(x_coordinates)
-  y_diff = y_grid - tf.math.floor(y_coordinates)
-  squared_distance = x_diff**2 + y_diff**2
-
-  gaussian_map = tf.exp(-squared_distance / (2 * sigma * sigma))
-
-  if channel_weights is not None:
-    gaussian_map = gaussian_map * channel_weights[tf.newaxis, tf.newaxis, :]
-
-  channel_indices = tf.argmax(channel_onehot, axis=1)
 
-  channel_indices = channel_indices[:, tf.newaxis]
-  heatmap_init = tf.zeros((num_channels, height, width))
+  height = shape_utils.combined_static_and_dynamic_shape(y_grid)[0]
+  width = shape_utils.combined_static_and_dynamic_shape(x_grid)[1]
+
+  # All instances share one window large enough for the widest Gaussian; it
+  # never needs to be larger than the image itself.
+  radius = tf.math.ceil(
+      tf.sqrt(2 * _GAUSSIAN_TRUNCATION_THRESHOLD) *
+      tf.maximum(tf.reduce_max(sigma), 0.0))
+  radius = tf.cast(radius, tf.int32)
+  window_height = tf.minimum(2 * radius + 1, height)
+  window_width = tf.minimum(2 * radius + 1, width)
+
+  # Each window is centered on its point and then shifted to lie within the
+  # image, so that points near or outside the border still cover all the
+  # pixels of the image within their radius. The start is clipped as a float
+  # so that far away points cannot overflow int32.
+  # Shapes: [num_instances, window_height] and [num_instances, window_width].
+  y_center = tf.math.floor(y_coordinates)
+  x_center = tf.math.floor(x_coordinates)
+  y_start = tf.cast(
+      tf.clip_by_value(y_center - tf.cast(radius, tf.float32), 0.0,
+                       tf.cast(height - window_height, tf.float32)), tf.int32)
+  x_start = tf.cast(
+      tf.clip_by_value(x_center - tf.cast(radius, tf.float32), 0.0,
+                       tf.cast(width - window_width, tf.float32)), tf.int32)
+  y_window = y_start[:, tf.newaxis] + tf.range(window_height)
+  x_window = x_start[:, tf.newaxis] + tf.range(window_width)
+  # As in the dense version, the pixel coordinates are read from the grids.
+  y_diff = tf.gather(y_grid[:, 0], y_window) - y_center[:, tf.newaxis]
+  x_diff = tf.gather(x_grid[0, :], x_window) - x_center[:, tf.newaxis]
+
+  # Only keep the window pixels whose Gaussian value is above the truncation
+  # threshold, i.e. within a per-instance radius of sqrt(2 * threshold) *
+  # sigma. Shape: [num_instances, window_height, window_width].
+  inv_two_sigma_squared = 1.0 / (2 * sigma * sigma)
+  exponent = ((y_diff[:, :, tf.newaxis]**2 + x_diff[:, tf.newaxis, :]**2) *
+              inv_two_sigma_squared[:, tf.newaxis, tf.newaxis])
+  keep = exponent < _GAUSSIAN_TRUNCATION_THRESHOLD
+
+  # The exponential is only evaluated and scattered for the kept pixels.
+  # Shape: [num_kept, 3] holding the instance, window row and window column.
+  kept = tf.where(keep)
+  instance_indices = kept[:, 0]
+  gaussian_values = (tf.exp(-tf.gather_nd(exponent, kept)) *
+                     tf.gather(channel_weights, instance_indices))
+  indices = tf.stack([
+      tf.gather_nd(y_window, kept[:, :2]),
+      tf.gather_nd(x_window, tf.gather(kept, [0, 2], axis=1)),
+      tf.gather(class_ids, instance_indices)
+  ], axis=-1)
 
-  gaussian_map = tf.transpose(gaussian_map, (2, 0, 1))
   heatmap = tf.tensor_scatter_nd_max(
-      heatmap_init, channel_indices, gaussian_map)
+      tf.zeros((height, width, num_channels)), indices, gaussian_values)
+  return tf.stop_gradient(heatmap)
 
-  # Maximum of an empty tensor is -inf, the following is to avoid that.
-  heatmap = tf.maximum(heatmap, 0)
 
-  return tf.stop_gradient(tf.transpose(heatmap, (1, 2, 0)))
+_HEATMAP_INPUT_SIGNATURE = [
+    tf.TensorSpec([None, None], tf.float32),  # y_grid
+    tf.TensorSpec([None, None], tf.float32),  # x_grid
+    tf.TensorSpec([None], tf.float32),  # y_coordinates
+    tf.TensorSpec([None], tf.float32),  # x_coordinates
+    tf.TensorSpec([None], tf.float32),  # sigma
+    tf.TensorSpec([None, None], tf.float32),  # channel_onehot
+    tf.TensorSpec([None], tf.float32),  # channel_weights
+]
+_coordinates_to_heatmap_dense_traced = tf.function(
+    _coordinates_to_heatmap_dense, input_signature=_HEATMAP_INPUT_SIGNATURE)
+_coordinates_to_heatmap_sparse_traced = tf.function(
+    _coordinates_to_heatmap_sparse, input_signature=_HEATMAP_INPUT_SIGNATURE)
 
 
 def coordinates_to_heatmap(y_grid,
@@ -122,7 +450,9 @@ def coordinates_to_heatmap(y_grid,
                            sigma,
                            channel_onehot,
                            channel_weights=None,
-                           sparse=False):
+                           sparse=False,
+                           class_ids=None,
+                           num_channels=None):
   """Returns the heatmap targets from a set of point coordinates.
 
   This function maps a set of point coordinates to the output heatmap image
@@ -132,10 +462,10 @@ def coordinates_to_heatmap(y_grid,
   refers to the number of keypoint types.
 
   Args:
-    y_grid: A 2D tensor with shape [height, width] which contains the grid
-      y-coordinates given in the (output) image dimensions.
-    x_grid: A 2D tensor with shape [height, width] which contains the grid
-      x-coordinates given in the (output) image dimensions.
+    y_grid: A 2D tensor with shape [height, 1] (or [height, width]) which
+      contains the grid y-coordinates given in the (output) image dimensions.
+    x_grid: A 2D tensor with shape [1, width] (or [height, width]) which
+      contains the grid x-coordinates given in the (output) image dimensions.
     y_coordinates: A 1D tensor with shape [num_instances] representing the
       y-coordinates of the instances in the output space coordinates.
     x_coordinates: A 1D tensor with shape [num_instances] representing the
@@ -143,26 +473,113 @@ def coordinates_to_heatmap(y_grid,
     sigma: A 1D tensor with shape [num_instances] representing the standard
       deviation of the Gaussian kernel to be applied to the point.
     channel_onehot: A 2D tensor with shape [num_instances, num_channels]
-      representing the one-hot encoded channel labels for each point.
+      representing the one-hot encoded channel labels for each point. May be
+      None if class_ids is provided.
     channel_weights: A 1D tensor with shape [num_instances] corresponding to the
       weight of each instance.
     sparse: bool, indicating whether or not to use the sparse implementation
       of the function. The sparse version scales better with number of channels,
-      but in some cases is known to cause OOM error. See (b/170989061).
+      but in some cases is known to cause OOM error. See (b/170989061). It
+      only evaluates the Gaussian within a window of ~3 sigma around each
+      point, so values below 1% of the peak are set to 0. The windows are
+      placed by pixel index, so the grids are expected to hold the pixel
+      indices as returned by image_shape_to_grids.
+    class_ids: An optional 1D int tensor with shape [num_instances] holding the
+      channel of each point. If provided, it is used instead of channel_onehot
+      and each point contributes to its channel with its weight. All ids must
+      be in the range [0, num_channels).
+    num_channels: int, the number of channels of the heatmap. Required if
+      class_ids is provided without channel_onehot.
 
   Returns:
     heatmap: A tensor of size [height, width, num_channels] representing the
       heatmap. Output (height, width) match the dimensions of the input grids.
+
+  Raises:
+    ValueError: if neither channel_onehot nor class_ids is provided, or if
+      num_channels is missing with class_ids.
+    tf.errors.InvalidArgumentError: if class_ids is not in the range
+      [0, num_channels).
   """
 
+  if class_ids is not None:
+    if num_channels is None:
+      if channel_onehot is None:
+        raise ValueError('num_channels must be provided with class_ids.')
+      num_channels = _get_num_channels(channel_onehot)
+    if channel_weights is None:
+      channel_weights = tf.ones_like(y_coordinates)
+    class_ids = tf.cast(class_ids, tf.int32)
+    # Out of range ids would otherwise be dropped or rejected depending on the
+    # implementation and the device.
+    with tf.control_dependencies([
+        tf.debugging.assert_non_negative(
+            class_ids, message='class_ids must be >= 0'),
+        tf.debugging.assert_less(
+            class_ids, tf.cast(num_channels, tf.int32),
+            message='class_ids must be < num_channels')
+    ]):
+      class_ids = tf.identity(class_ids)
+    if sparse:
+      return _coordinates_to_heatmap_sparse_from_class_ids(
+          y_grid, x_grid, y_coordinates, x_coordinates, sigma, class_ids,
+          channel_weights, num_channels)
+    return _coordinates_to_heatmap_dense_from_class_ids(
+        y_grid, x_grid, y_coordinates, x_coordinates, sigma, class_ids,
+        channel_weights, num_channels)
+  if channel_onehot is None:
+    raise ValueError('Either channel_onehot or class_ids must be provided.')
+
   if sparse:
-    return _coordinates_to_heatmap_sparse(
+    heatmap_fn = _coordinates_to_heatmap_sparse
+    traced_heatmap_fn = _coordinates_to_heatmap_sparse_traced
+  elif _can_use_numba(y_grid, x_grid, y_coordinates, x_coordinates, sigma,
+                      channel_onehot, channel_weights):
+    # Eager execution pays a dispatch cost for every op, which dominates for
+    # small inputs, so the whole computation is run in a native kernel.
+    return _coordinates_to_heatmap_eager_cpu(
         y_grid, x_grid, y_coordinates, x_coordinates, sigma, channel_onehot,
         channel_weights)
   else:
-    return _coordinates_to_heatmap_dense(
-        y_grid, x_grid, y_coordinates, x_coordinates, sigma, channel_onehot,
-        channel_weights)
+    heatmap_fn = _coordinates_to_heatmap_dense
+    traced_heatmap_fn = _coordinates_to_heatmap_dense_traced
+
+  inputs = [y_grid, x_grid, y_coordinates, x_coordinates, sigma, channel_onehot]
+  if channel_weights is not None:
+    inputs.append(channel_weights)
+  if _can_use_traced_function(inputs):
+    if channel_weights is None:
+      inputs.append(tf.ones_like(y_coordinates))
+    return traced_heatmap_fn(*inputs)
+  return heatmap_fn(*inputs)
+
+
+def _floor_offsets_with_indices(y_source, x_source, y_target=None,
+                                x_target=None):
+  """Computes the offsets and indices given broadcast-compatible targets."""
+  # The y and x coordinates are stacked up front so that the floor, the offset
+  # and the cast each run once on the [..., 2] tensor.
+  source = tf.stack([y_source, x_source], axis=-1)
+  source_floored = tf.floor(source)
+  if y_target is None:
+    target = source
+  else:
+    target = tf.stack([y_target, x_target], axis=-1)
+
+  offsets = target - source_floored
+  # The floored values are reused for the indices. A truncating cast alone is
+  # not the floor for negative coordinates.
+  indices = tf.cast(source_floored, tf.int32)
+  return offsets, indices
+
+
+# All ops are rank agnostic, so a single trace serves every input rank.
+_floor_offsets_with_indices_traced = tf.function(
+    _floor_offsets_with_indices,
+    input_signature=[tf.TensorSpec(None, tf.float32)] * 4)
+_floor_offsets_with_indices_from_source_traced = tf.function(
+    _floor_offsets_with_indices,
+    input_signature=[tf.TensorSpec(None, tf.float32)] * 2)
 
 
 def compute_floor_offsets_with_indices(y_source,
@@ -205,33 +622,25 @@ def compute_floor_offsets_with_indices(y_source,
   Raise:
     ValueError: source and target shapes have unexpected values.
   """
-  y_source_floored = tf.floor(y_source)
-  x_source_floored = tf.floor(x_source)
-
   source_shape = shape_utils.combined_static_and_dynamic_shape(y_source)
   if y_target is None and x_target is None:
-    y_target = y_source
-    x_target = x_source
+    # The sources are used as the targets.
+    if _can_use_traced_function([y_source, x_source]):
+      return _floor_offsets_with_indices_from_source_traced(y_source, x_source)
+    return _floor_offsets_with_indices(y_source, x_source)
   else:
     target_shape = shape_utils.combined_static_and_dynamic_shape(y_target)
     if len(source_shape) == 2 and len(target_shape) == 1:
-      _, num_neighbors = source_shape
-      y_target = tf.tile(
-          tf.expand_dims(y_target, -1), multiples=[1, num_neighbors])
-      x_target = tf.tile(
-          tf.expand_dims(x_target, -1), multiples=[1, num_neighbors])
+      # The [num_points, 1] targets broadcast over the neighbors dimension.
+      y_target = tf.expand_dims(y_target, -1)
+      x_target = tf.expand_dims(x_target, -1)
     elif source_shape != target_shape:
       raise ValueError('Inconsistent source and target shape.')
 
-  y_offset = y_target - y_source_floored
-  x_offset = x_target - x_source_floored
-
-  y_source_indices = tf.cast(y_source_floored, tf.int32)
-  x_source_indices = tf.cast(x_source_floored, tf.int32)
-
-  indices = tf.stack([y_source_indices, x_source_indices], axis=-1)
-  offsets = tf.stack([y_offset, x_offset], axis=-1)
-  return offsets, indices
+  if _can_use_traced_function([y_source, x_source, y_target, x_target]):
+    return _floor_offsets_with_indices_traced(y_source, x_source, y_target,
+                                              x_target)
+  return _floor_offsets_with_indices(y_source, x_source, y_target, x_target)
 
 
 def get_valid_keypoint_mask_for_class(keypoint_coordinates,
@@ -244,8 +653,8 @@ def get_valid_keypoint_mask_for_class(keypoint_coordinates,
   For a given task, we may want to only consider a subset of instances or
   keypoints. This function is used to provide the mask (in terms of weights) to
   mark those elements which should be considered based on the classes of the
-  instances and optionally, their keypoint indices. Note that the NaN values
-  in the keypoints will also be masked out.
+  instances and optionally, their keypoint indices. Note that the keypoints
+  with NaN or infinite coordinates will also be masked out.
 
   Args:
     keypoint_coordinates: A float tensor with shape [num_instances,
@@ -264,31 +673,154 @@ def get_valid_keypoint_mask_for_class(keypoint_coordinates,
       mask: A float tensor of shape [num_instances, K], where K is num_keypoints
         or len(keypoint_indices) if provided. The tensor has values either 0 or
         1 indicating whether an element in the input keypoints should be used.
-      keypoints_nan_to_zeros: Same as input keypoints with the NaN values
-        replaced by zeros and selected columns corresponding to the
-        keypoint_indices (if provided). The shape of this tensor will always be
-        the same as the output mask.
+      keypoints_nan_to_zeros: Same as input keypoints with the NaN and
+        infinite values replaced by zeros and selected columns corresponding to
+        the keypoint_indices (if provided). The shape of this tensor will
+        always be the same as the output mask.
   """
-  num_keypoints = tf.shape(keypoint_coordinates)[1]
-  class_mask = class_onehot[:, class_id]
-  reshaped_class_mask = tf.tile(
-      tf.expand_dims(class_mask, axis=-1), multiples=[1, num_keypoints])
-  not_nan = tf.math.logical_not(tf.math.is_nan(keypoint_coordinates))
-  mask = reshaped_class_mask * tf.cast(not_nan[:, :, 0], dtype=tf.float32)
-  keypoints_nan_to_zeros = tf.where(not_nan, keypoint_coordinates,
+  # The masks are kept as boolean tensors and only cast to float at the end.
+  class_mask = tf.cast(class_onehot[:, class_id], dtype=tf.bool)
+  is_finite = tf.math.is_finite(keypoint_coordinates)
+  # A keypoint is valid only when both of its coordinates are finite.
+  # The [num_instances, 1] class mask broadcasts over the keypoint dimension.
+  mask = tf.logical_and(class_mask[:, tf.newaxis],
+                        tf.reduce_all(is_finite, axis=-1))
+  keypoints_nan_to_zeros = tf.where(is_finite, keypoint_coordinates,
                                     tf.zeros_like(keypoint_coordinates))
-  if class_weights is not None:
-    reshaped_class_weight = tf.tile(
-        tf.expand_dims(class_weights, axis=-1), multiples=[1, num_keypoints])
-    mask = mask * reshaped_class_weight
 
   if keypoint_indices is not None:
     mask = tf.gather(mask, indices=keypoint_indices, axis=1)
     keypoints_nan_to_zeros = tf.gather(
         keypoints_nan_to_zeros, indices=keypoint_indices, axis=1)
+
+  mask = tf.cast(mask, dtype=tf.float32)
+  if class_weights is not None:
+    mask = mask * class_weights[:, tf.newaxis]
   return mask, keypoints_nan_to_zeros
 
 
+def _blackout_corner_updates(height, width, boxes, blackout):
+  """Returns the difference grid corners of the boxes to blackout.
+
+  Pixel (y, x) is in a box when y_min <= y <= y_max and x_min <= x <= x_max,
+  i.e. the box covers the half-open pixel ranges [y_start, y_end) and
+  [x_start, x_end). Adding +1 at (y_start, x_start) and (y_end, x_end) and -1
+  at the two other corners of a [height + 1, width + 1] grid makes its 2D
+  prefix sum count the boxes covering each pixel.
+
+  Args:
+    height: int32 scalar tensor, height of the (output) image.
+    width: int32 scalar tensor, width of the (output) image.
+    boxes: A float tensor with shape [..., 4].
+    blackout: A boolean tensor with shape [...].
+
+  Returns:
+    indices: An int32 tensor with shape [..., 4, 2] holding the (y, x) corners.
+    updates: An int32 tensor with shape [..., 4] holding the corner values,
+      which are zero for boxes that are not selected or cover no pixel.
+  """
+  # The coordinates are clipped before the cast so that very large or infinite
+  # values cannot overflow int32.
+  float_height = tf.cast(height, boxes.dtype)
+  float_width = tf.cast(width, boxes.dtype)
+  y_start = tf.cast(
+      tf.clip_by_value(tf.math.ceil(boxes[..., 0]), 0, float_height), tf.int32)
+  x_start = tf.cast(
+      tf.clip_by_value(tf.math.ceil(boxes[..., 1]), 0, float_width), tf.int32)
+  y_end = tf.cast(
+      tf.clip_by_value(tf.math.floor(boxes[..., 2]) + 1, 0, float_height),
+      tf.int32)
+  x_end = tf.cast(
+      tf.clip_by_value(tf.math.floor(boxes[..., 3]) + 1, 0, float_width),
+      tf.int32)
+
+  # Only select the boxes specified by blackout which cover at least one pixel.
+  # Boxes with NaN coordinates cover no pixel, but their corners are not valid
+  # indices and are checked separately.
+  is_valid = tf.reduce_all(tf.logical_not(tf.math.is_nan(boxes)), axis=-1)
+  selected = tf.logical_and(
+      tf.logical_and(blackout, is_valid),
+      tf.logical_and(y_start < y_end, x_start < x_end))
+  box_weights = tf.cast(selected, tf.int32)
+
+  indices = tf.stack([
+      tf.stack([y_start, x_start], axis=-1),
+      tf.stack([y_start, x_end], axis=-1),
+      tf.stack([y_end, x_start], axis=-1),
+      tf.stack([y_end, x_end], axis=-1)
+  ], axis=-2)
+  # The corners of the boxes which are not selected are moved to (0, 0), where
+  # their zero updates are always in bounds.
+  indices = indices * box_weights[..., tf.newaxis, tf.newaxis]
+  updates = tf.stack(
+      [box_weights, -box_weights, -box_weights, box_weights], axis=-1)
+  return indices, updates
+
+
+def _pixel_weights_from_corners(corners, height, width):
+  """Converts a [..., height + 1, width + 1] difference grid to weights."""
+  num_covering_boxes = tf.cumsum(tf.cumsum(corners, axis=-2), axis=-1)
+  # The coverage stays boolean and is only cast to float for the output.
+  in_boxes = num_covering_boxes[..., :height, :width] > 0
+  return tf.cast(tf.logical_not(in_boxes), tf.float32)
+
+
+def _blackout_pixel_weights(height, width, boxes, blackout):
+  """Computes the blackout pixel weights with a 2D prefix sum.
+
+  The work is 4 scatters per box plus two cumsums over the image, so the graph
+  does not depend on the number of boxes. If no annotation instance is
+  provided, nothing is scattered and the weights are all ones, which avoids a
+  NaN loss value.
+  """
+  height = tf.cast(height, tf.int32)
+  width = tf.cast(width, tf.int32)
+  indices, updates = _blackout_corner_updates(height, width, boxes, blackout)
+  corners = tf.scatter_nd(
+      tf.reshape(indices, [-1, 2]), tf.reshape(updates, [-1]),
+      tf.stack([height + 1, width + 1]))
+  return _pixel_weights_from_corners(corners, height, width)
+
+
+def _blackout_pixel_weights_batched(height, width, boxes, blackout):
+  """Computes the blackout pixel weights of a batch with one scatter."""
+  height = tf.cast(height, tf.int32)
+  width = tf.cast(width, tf.int32)
+  # Shapes: [batch_size, num_instances, 4, 2] and [batch_size, num_instances,
+  # 4].
+  indices, updates = _blackout_corner_updates(height, width, boxes, blackout)
+  batch_size = tf.shape(boxes)[0]
+  # Prepend the image index so that every image gets its own difference grid.
+  batch_indices = tf.broadcast_to(
+      tf.reshape(tf.range(batch_size), [-1, 1, 1, 1]),
+      tf.shape(indices[..., :1]))
+  indices = tf.concat([batch_indices, indices], axis=-1)
+  corners = tf.scatter_nd(
+      tf.reshape(indices, [-1, 3]), tf.reshape(updates, [-1]),
+      tf.stack([batch_size, height + 1, width + 1]))
+  return _pixel_weights_from_corners(corners, height, width)
+
+
+_blackout_pixel_weights_traced = tf.function(
+    _blackout_pixel_weights,
+    input_signature=[
+        tf.TensorSpec([], tf.int32),  # height
+        tf.TensorSpec([], tf.int32),  # width
+        tf.TensorSpec([None, 4], tf.float32),  # boxes
+        tf.TensorSpec([None], tf.bool),  # blackout
+    ])
+
+
+_blackout_pixel_weights_batched_traced = tf.function(
+    _blackout_pixel_weights_batched,
+    input_signature=[
+        tf.TensorSpec([], tf.int32),  # height
+        tf.TensorSpec([], tf.int32),  # width
+        tf.TensorSpec([None, None, 4], tf.float32),  # boxes
+        tf.TensorSpec([None, None], tf.bool),  # blackout
+    ])
+
+
 def blackout_pixel_weights_by_box_regions(height, width, boxes, blackout):
   """Blackout the pixel weights in the target box regions.
 
@@ -307,38 +839,44 @@ def blackout_pixel_weights_by_box_regions(height, width, boxes, blackout):
     A float tensor with shape [height, width] where all values within the
     regions of the blackout boxes are 0.0 and 1.0 else where.
   """
-  num_instances, _ = shape_utils.combined_static_and_dynamic_shape(boxes)
-  # If no annotation instance is provided, return all ones (instead of
-  # unexpected values) to avoid NaN loss value.
-  if num_instances == 0:
-    return tf.ones([height, width], dtype=tf.float32)
-
-  (y_grid, x_grid) = image_shape_to_grids(height, width)
-  y_grid = tf.expand_dims(y_grid, axis=0)
-  x_grid = tf.expand_dims(x_grid, axis=0)
-  y_min = tf.expand_dims(boxes[:, 0:1], axis=-1)
-  x_min = tf.expand_dims(boxes[:, 1:2], axis=-1)
-  y_max = tf.expand_dims(boxes[:, 2:3], axis=-1)
-  x_max = tf.expand_dims(boxes[:, 3:], axis=-1)
-
-  # Make the mask with all 1.0 in the box regions.
-  # Shape: [num_instances, height, width]
-  in_boxes = tf.cast(
-      tf.logical_and(
-          tf.logical_and(y_grid >= y_min, y_grid <= y_max),
-          tf.logical_and(x_grid >= x_min, x_grid <= x_max)),
-      dtype=tf.float32)
-
-  # Shape: [num_instances, height, width]
-  blackout = tf.tile(
-      tf.expand_dims(tf.expand_dims(blackout, axis=-1), axis=-1),
-      [1, height, width])
-
-  # Select only the boxes specified by blackout.
-  selected_in_boxes = tf.where(blackout, in_boxes, tf.zeros_like(in_boxes))
-  out_boxes = tf.reduce_max(selected_in_boxes, axis=0)
-  out_boxes = tf.ones_like(out_boxes) - out_boxes
-  return out_boxes
+  if (_can_use_traced_function([boxes]) and
+      _can_use_traced_function([blackout], dtype=tf.bool)):
+    return _blackout_pixel_weights_traced(
+        tf.cast(height, tf.int32), tf.cast(width, tf.int32), boxes, blackout)
+  return _blackout_pixel_weights(height, width, boxes, blackout)
+
+
+def blackout_pixel_weights_by_box_regions_batched(height, width, boxes,
+                                                  blackout, valid_mask=None):
+  """Blackout the pixel weights in the target box regions of a batch.
+
+  This is the batched version of `blackout_pixel_weights_by_box_regions`. All
+  images are handled by a single scatter and prefix sum instead of a per-image
+  loop.
+
+  Args:
+    height: int, height of the (output) image.
+    width: int, width of the (output) image.
+    boxes: A float tensor with shape [batch_size, num_instances, 4] indicating
+      the coordinates of the four corners of the boxes.
+    blackout: A boolean tensor with shape [batch_size, num_instances]
+      indicating whether to blackout (zero-out) the weights within the box
+      regions.
+    valid_mask: (optional) A boolean tensor with shape [batch_size,
+      num_instances] indicating which boxes are valid, e.g. not padding. If
+      not provided, all boxes are considered valid.
+
+  Returns:
+    A float tensor with shape [batch_size, height, width] where all values
+    within the regions of the valid blackout boxes are 0.0 and 1.0 else where.
+  """
+  if valid_mask is not None:
+    blackout = tf.logical_and(blackout, valid_mask)
+  if (_can_use_traced_function([boxes]) and
+      _can_use_traced_function([blackout], dtype=tf.bool)):
+    return _blackout_pixel_weights_batched_traced(
+        tf.cast(height, tf.int32), tf.cast(width, tf.int32), boxes, blackout)
+  return _blackout_pixel_weights_batched(height, width, boxes, blackout)
 
 
 def _get_yx_indices_offset_by_radius(radius):
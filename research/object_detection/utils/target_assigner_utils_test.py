@@ -29,8 +29,8 @@ class TargetUtilTest(parameterized.TestCase, test_case.TestCase):
       (y_grid, x_grid) = ta_utils.image_shape_to_grids(height=2, width=3)
       return y_grid, x_grid
 
-    expected_y_grid = np.array([[0, 0, 0], [1, 1, 1]])
-    expected_x_grid = np.array([[0, 1, 2], [0, 1, 2]])
+    expected_y_grid = np.array([[0], [1]])
+    expected_x_grid = np.array([[0, 1, 2]])
 
     y_grid, x_grid = self.execute(graph_fn, [])
 
@@ -61,6 +61,153 @@ class TargetUtilTest(parameterized.TestCase, test_case.TestCase):
     # Peak at (0, 4) for the second class.
     self.assertAlmostEqual(1.0, heatmap[0, 4, 1])
 
+  def test_coordinates_to_heatmap_sparse_matches_dense(self):
+    if not hasattr(tf, 'tensor_scatter_nd_max'):
+      self.skipTest('Cannot test function due to old TF version.')
+
+    def graph_fn():
+      (y_grid, x_grid) = ta_utils.image_shape_to_grids(height=20, width=30)
+      # The last two points lie outside of the image, near its border.
+      y_coordinates = tf.constant([1.5, 10.5, 19.2, -3.0, 22.5],
+                                  dtype=tf.float32)
+      x_coordinates = tf.constant([2.5, 14.5, 29.9, 31.5, -2.0],
+                                  dtype=tf.float32)
+      sigma = tf.constant([0.5, 2.0, 4.0, 3.0, 2.0], dtype=tf.float32)
+      channel_onehot = tf.constant([[1, 0], [0, 1], [1, 0], [0, 1], [0, 1]],
+                                   dtype=tf.float32)
+      channel_weights = tf.constant([1, 0.5, 1, 1, 1], dtype=tf.float32)
+      dense_heatmap = ta_utils.coordinates_to_heatmap(
+          y_grid, x_grid, y_coordinates, x_coordinates, sigma, channel_onehot,
+          channel_weights, sparse=False)
+      sparse_heatmap = ta_utils.coordinates_to_heatmap(
+          y_grid, x_grid, y_coordinates, x_coordinates, sigma, channel_onehot,
+          channel_weights, sparse=True)
+
+      # A Gaussian wider than the image, centered below it.
+      (small_y_grid, small_x_grid) = ta_utils.image_shape_to_grids(
+          height=4, width=4)
+      small_inputs = [
+          small_y_grid, small_x_grid,
+          tf.constant([4.2]), tf.constant([1.0]), tf.constant([2.0]),
+          tf.constant([[1.0]])
+      ]
+      small_dense_heatmap = ta_utils.coordinates_to_heatmap(
+          *small_inputs, sparse=False)
+      small_sparse_heatmap = ta_utils.coordinates_to_heatmap(
+          *small_inputs, sparse=True)
+      return (dense_heatmap, sparse_heatmap, small_dense_heatmap,
+              small_sparse_heatmap)
+
+    (dense_heatmap, sparse_heatmap, small_dense_heatmap,
+     small_sparse_heatmap) = self.execute(graph_fn, [])
+    # The sparse version only truncates values below 1% of the peak.
+    np.testing.assert_allclose(dense_heatmap, sparse_heatmap, atol=0.01)
+    np.testing.assert_allclose(small_dense_heatmap, small_sparse_heatmap,
+                               atol=0.01)
+
+  def test_coordinates_to_heatmap_eager_cpu_matches_dense(self):
+    if ta_utils.numba is None or not tf.executing_eagerly():
+      self.skipTest('The numba fast path requires numba and eager mode.')
+
+    with tf.device('/cpu:0'):
+      (y_grid, x_grid) = ta_utils.image_shape_to_grids(height=20, width=30)
+      y_coordinates = tf.constant([1.5, 10.5, 19.2], dtype=tf.float32)
+      x_coordinates = tf.constant([2.5, 14.5, 29.9], dtype=tf.float32)
+      sigma = tf.constant([0.5, 2.0, 4.0], dtype=tf.float32)
+      channel_onehot = tf.constant([[1, 0], [0, 1], [1, 1]], dtype=tf.float32)
+      channel_weights = tf.constant([1, 0.5, 1], dtype=tf.float32)
+      numba_heatmap = ta_utils.coordinates_to_heatmap(
+          y_grid, x_grid, y_coordinates, x_coordinates, sigma, channel_onehot,
+          channel_weights)
+      dense_heatmap = ta_utils._coordinates_to_heatmap_dense(
+          y_grid, x_grid, y_coordinates, x_coordinates, sigma, channel_onehot,
+          channel_weights)
+    np.testing.assert_allclose(numba_heatmap.numpy(), dense_heatmap.numpy(),
+                               atol=1e-6)
+
+  def test_coordinates_to_heatmap_keeps_float64(self):
+    if not tf.executing_eagerly():
+      self.skipTest('Test requires eager mode to check the CPU fast path.')
+
+    with tf.device('/cpu:0'):
+      (y_grid, x_grid) = ta_utils.image_shape_to_grids(height=3, width=5)
+      heatmap = ta_utils.coordinates_to_heatmap(
+          tf.cast(y_grid, tf.float64), tf.cast(x_grid, tf.float64),
+          tf.constant([1.5], dtype=tf.float64),
+          tf.constant([2.5], dtype=tf.float64),
+          tf.constant([0.5], dtype=tf.float64),
+          tf.constant([[1, 0]], dtype=tf.float64))
+    self.assertEqual(tf.float64, heatmap.dtype)
+
+  @parameterized.parameters((False,), (True,))
+  def test_coordinates_to_heatmap_class_ids(self, sparse):
+    if not hasattr(tf, 'tensor_scatter_nd_max'):
+      self.skipTest('Cannot test function due to old TF version.')
+
+    def graph_fn():
+      (y_grid, x_grid) = ta_utils.image_shape_to_grids(height=20, width=30)
+      y_coordinates = tf.constant([1.5, 10.5, 19.2], dtype=tf.float32)
+      x_coordinates = tf.constant([2.5, 14.5, 29.9], dtype=tf.float32)
+      sigma = tf.constant([0.5, 2.0, 4.0], dtype=tf.float32)
+      channel_onehot = tf.constant([[1, 0, 0], [0, 0, 1], [1, 0, 0]],
+                                   dtype=tf.float32)
+      class_ids = tf.constant([0, 2, 0], dtype=tf.int32)
+      channel_weights = tf.constant([1, 0.5, 1], dtype=tf.float32)
+      onehot_heatmap = ta_utils.coordinates_to_heatmap(
+          y_grid, x_grid, y_coordinates, x_coordinates, sigma, channel_onehot,
+          channel_weights, sparse=sparse)
+      class_ids_heatmap = ta_utils.coordinates_to_heatmap(
+          y_grid, x_grid, y_coordinates, x_coordinates, sigma,
+          channel_onehot=None, channel_weights=channel_weights, sparse=sparse,
+          class_ids=class_ids, num_channels=3)
+      return onehot_heatmap, class_ids_heatmap
+
+    onehot_heatmap, class_ids_heatmap = self.execute(graph_fn, [])
+    self.assertEqual((20, 30, 3), class_ids_heatmap.shape)
+    np.testing.assert_allclose(onehot_heatmap, class_ids_heatmap, atol=1e-6)
+
+  @parameterized.parameters((False, -1), (False, 3), (True, -1), (True, 3))
+  def test_coordinates_to_heatmap_class_ids_out_of_range(self, sparse,
+                                                         class_id):
+    if not hasattr(tf, 'tensor_scatter_nd_max'):
+      self.skipTest('Cannot test function due to old TF version.')
+
+    def graph_fn():
+      (y_grid, x_grid) = ta_utils.image_shape_to_grids(height=20, width=30)
+      y_coordinates = tf.constant([1.5, 10.5], dtype=tf.float32)
+      x_coordinates = tf.constant([2.5, 14.5], dtype=tf.float32)
+      sigma = tf.constant([0.5, 2.0], dtype=tf.float32)
+      class_ids = tf.constant([0, class_id], dtype=tf.int32)
+      return ta_utils.coordinates_to_heatmap(
+          y_grid, x_grid, y_coordinates, x_coordinates, sigma,
+          channel_onehot=None, sparse=sparse, class_ids=class_ids,
+          num_channels=3)
+
+    with self.assertRaises(tf.errors.InvalidArgumentError):
+      self.execute(graph_fn, [])
+
+  def test_coordinates_to_heatmap_khot(self):
+
+    def graph_fn():
+      (y_grid, x_grid) = ta_utils.image_shape_to_grids(height=3, width=5)
+      y_coordinates = tf.constant([1.5, 0.5], dtype=tf.float32)
+      x_coordinates = tf.constant([2.5, 4.5], dtype=tf.float32)
+      sigma = tf.constant([0.1, 0.5], dtype=tf.float32)
+      channel_onehot = tf.constant([[1, 0, 1], [0, 1, 0]], dtype=tf.float32)
+      channel_weights = tf.constant([0.5, 1], dtype=tf.float32)
+      heatmap = ta_utils.coordinates_to_heatmap(y_grid, x_grid, y_coordinates,
+                                                x_coordinates, sigma,
+                                                channel_onehot,
+                                                channel_weights)
+      return heatmap
+
+    heatmap = self.execute(graph_fn, [])
+    # The first instance contributes (weighted) peaks to both of its classes.
+    self.assertAlmostEqual(0.5, heatmap[1, 2, 0])
+    self.assertAlmostEqual(0.5, heatmap[1, 2, 2])
+    self.assertAlmostEqual(1.0, heatmap[0, 4, 1])
+    self.assertAlmostEqual(0.0, heatmap[0, 4, 2])
+
   def test_compute_floor_offsets_with_indices_onlysource(self):
 
     def graph_fn():
@@ -120,6 +267,34 @@ class TargetUtilTest(parameterized.TestCase, test_case.TestCase):
     np.testing.assert_array_almost_equal(indices[:, 1, :],
                                          np.array([[0, 4], [3, 3]]))
 
+  def test_compute_floor_offsets_with_indices_eager(self):
+    if not tf.executing_eagerly():
+      self.skipTest('The traced version is only used in eager mode.')
+
+    offsets, indices = ta_utils.compute_floor_offsets_with_indices(
+        tf.constant([1.5, -0.3]), tf.constant([2.5, 4.2]))
+    np.testing.assert_array_almost_equal(offsets.numpy(),
+                                         np.array([[0.5, 0.5], [0.7, 0.2]]))
+    np.testing.assert_array_equal(indices.numpy(), np.array([[1, 2], [-1, 4]]))
+
+    offsets, indices = ta_utils.compute_floor_offsets_with_indices(
+        tf.constant([1.5]), tf.constant([2.5]), tf.constant([2.1]),
+        tf.constant([1.2]))
+    np.testing.assert_array_almost_equal(offsets.numpy(),
+                                         np.array([[1.1, -0.8]]))
+
+    # Inputs of a different rank reuse the same trace.
+    traced_fn = ta_utils._floor_offsets_with_indices_traced
+    tracing_count = traced_fn.experimental_get_tracing_count()
+    offsets, indices = ta_utils.compute_floor_offsets_with_indices(
+        tf.constant([[1.0, 0.0]]), tf.constant([[2.0, 4.0]]),
+        tf.constant([2.1]), tf.constant([1.2]))
+    np.testing.assert_array_almost_equal(offsets.numpy(),
+                                         np.array([[[1.1, -0.8], [2.1, -2.8]]]))
+    np.testing.assert_array_equal(indices.numpy(),
+                                  np.array([[[1, 2], [0, 4]]]))
+    self.assertEqual(tracing_count, traced_fn.experimental_get_tracing_count())
+
   def test_get_valid_keypoints_mask(self):
 
     def graph_fn():
@@ -184,6 +359,30 @@ class TargetUtilTest(parameterized.TestCase, test_case.TestCase):
     np.testing.assert_array_almost_equal(keypoints_nan_to_zeros,
                                          expected_keypoints)
 
+  def test_get_valid_keypoints_mask_non_finite(self):
+    def graph_fn():
+      class_onehot = tf.constant([[0, 1], [0, 1]], dtype=tf.float32)
+      keypoint_coordinates = tf.constant(
+          [[[0.1, 0.2], [float('inf'), 0.3], [0.4, float('nan')]],
+           [[0.5, -float('inf')], [0.6, 0.7], [0.8, 0.9]]],
+          dtype=tf.float32)
+      mask, keypoints_nan_to_zeros = ta_utils.get_valid_keypoint_mask_for_class(
+          keypoint_coordinates=keypoint_coordinates,
+          class_id=1,
+          class_onehot=class_onehot)
+      return mask, keypoints_nan_to_zeros
+
+    # A keypoint is masked out if either of its coordinates is not finite.
+    expected_mask = np.array([[1, 0, 0], [0, 1, 1]])
+    expected_keypoints = np.array(
+        [[[0.1, 0.2], [0.0, 0.3], [0.4, 0.0]],
+         [[0.5, 0.0], [0.6, 0.7], [0.8, 0.9]]])
+    mask, keypoints_nan_to_zeros = self.execute(graph_fn, [])
+
+    np.testing.assert_array_equal(mask, expected_mask)
+    np.testing.assert_array_almost_equal(keypoints_nan_to_zeros,
+                                         expected_keypoints)
+
   def test_blackout_pixel_weights_by_box_regions(self):
     def graph_fn():
       boxes = tf.constant(
@@ -217,6 +416,78 @@ class TargetUtilTest(parameterized.TestCase, test_case.TestCase):
     # The output should be all 1s since there's no annotation provided.
     np.testing.assert_array_equal(output, np.ones([10, 20], dtype=np.float32))
 
+  def test_blackout_pixel_weights_by_box_regions_dynamic_instances(self):
+    if not tf.executing_eagerly():
+      self.skipTest('Test requires eager mode to call the tf.function.')
+
+    blackout_pixel_weights_by_box_regions = tf.function(
+        ta_utils.blackout_pixel_weights_by_box_regions,
+        input_signature=[
+            tf.TensorSpec([], tf.int32),
+            tf.TensorSpec([], tf.int32),
+            tf.TensorSpec([None, 4], tf.float32),
+            tf.TensorSpec([None], tf.bool)
+        ])
+    output = blackout_pixel_weights_by_box_regions(
+        10, 20, tf.zeros([0, 4]), tf.zeros([0], dtype=tf.bool))
+    np.testing.assert_array_equal(output, np.ones([10, 20], dtype=np.float32))
+
+    output = blackout_pixel_weights_by_box_regions(
+        10, 20, tf.constant([[0.0, 0.0, 5, 5], [6.0, 12.0, 8.0, 18.0]]),
+        tf.constant([True, True]))
+    # 20 * 10 - 6 * 6 - 3 * 7 = 143.0
+    self.assertAlmostEqual(np.sum(output), 143.0)
+    # Both calls share the same graph.
+    tracing_count = (
+        blackout_pixel_weights_by_box_regions.experimental_get_tracing_count())
+    self.assertEqual(1, tracing_count)
+
+  def test_blackout_pixel_weights_by_box_regions_large_boxes(self):
+    def graph_fn():
+      # The last box has a NaN coordinate and is never blacked out.
+      boxes = tf.constant(
+          [[0.0, 0.0, 3e9, 3e9], [-float('inf'), 2.0, 1.0, float('inf')],
+           [float('nan'), 0.0, 3.0, 3.0]],
+          dtype=tf.float32)
+      large_box_output = ta_utils.blackout_pixel_weights_by_box_regions(
+          4, 4, boxes, tf.constant([True, False, True]))
+      infinite_box_output = ta_utils.blackout_pixel_weights_by_box_regions(
+          4, 4, boxes, tf.constant([False, True, True]))
+      return large_box_output, infinite_box_output
+
+    large_box_output, infinite_box_output = self.execute(graph_fn, [])
+    np.testing.assert_array_equal(large_box_output, np.zeros([4, 4]))
+    # The infinite box covers the region [0:2, 2:4].
+    expected_output = np.ones([4, 4])
+    expected_output[0:2, 2:4] = 0.0
+    np.testing.assert_array_equal(infinite_box_output, expected_output)
+
+  def test_blackout_pixel_weights_by_box_regions_batched(self):
+    boxes = np.array(
+        [[[0.0, 0.0, 5, 5], [0.0, 0.0, 10.0, 20.0], [6.0, 12.0, 8.0, 18.0]],
+         [[2.0, 3.0, 4.0, 7.0], [0.0, 0.0, 10.0, 20.0], [0.0, 0.0, 0.0, 0.0]]],
+        dtype=np.float32)
+    blackout = np.array([[True, False, True], [True, True, True]])
+    valid_mask = np.array([[True, True, True], [True, False, False]])
+
+    def graph_fn():
+      batched_output = ta_utils.blackout_pixel_weights_by_box_regions_batched(
+          10, 20, tf.constant(boxes), tf.constant(blackout),
+          tf.constant(valid_mask))
+      outputs = [
+          ta_utils.blackout_pixel_weights_by_box_regions(
+              10, 20, tf.constant(boxes[i]),
+              tf.constant(np.logical_and(blackout[i], valid_mask[i])))
+          for i in range(2)
+      ]
+      return batched_output, tf.stack(outputs)
+
+    batched_output, expected_output = self.execute(graph_fn, [])
+    self.assertEqual(batched_output.shape, (2, 10, 20))
+    np.testing.assert_array_equal(batched_output, expected_output)
+    # 20 * 10 - 3 * 5 = 185.0
+    self.assertAlmostEqual(np.sum(batched_output[1]), 185.0)
+
   def test_get_surrounding_grids(self):
 
     def graph_fn():